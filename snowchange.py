@@ -1,21 +1,79 @@
 import os
 import re
 import argparse
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import dataclasses
+import functools
+import threading
 import time
 import hashlib
 import snowflake.connector
+import snowflake.connector.errors
 
 # Set a few global variables here
-_snowchange_version = '2.1.0'
+_snowchange_version = '2.2.0'
 _metadata_database_name = 'METADATA'
 _metadata_schema_name = 'SNOWCHANGE'
 _metadata_table_name = 'CHANGE_HISTORY'
 
-
-def snowchange(root_folder, snowflake_account, snowflake_region, snowflake_user, snowflake_role, snowflake_warehouse, change_history_table_override, verbose):
+# One parsed change script from the root folder. A namedtuple rather than a dict
+# per script keeps the walk results compact when scanning large script folders.
+Script = collections.namedtuple('Script', ['name', 'full_path', 'type', 'version', 'description'])
+
+# All the details needed to open a Snowflake connection, built once from the CLI
+# arguments and passed explicitly instead of being marshaled through os.environ
+# (which was both slower and unsafe to share across worker threads)
+@dataclasses.dataclass(frozen=True)
+class SnowflakeConfig:
+  account: str
+  region: str
+  user: str
+  role: str
+  warehouse: str
+  password: str
+  authenticator: str = 'snowflake'
+
+# Compile the hot-loop regexes once at module load rather than per file/version string
+_script_name_pattern = re.compile(r'^([V])(.+)__(.+)\.sql$')
+_alphanum_pattern = re.compile('([0-9]+)')
+
+# The shape of version string for which the SQL max-version ordering below agrees
+# with get_alphanum_key: purely numeric, dotted, at most four parts
+_simple_version_pattern = re.compile(r'^\d+(\.\d+){0,3}$')
+
+# SQL statement templates, built once at module load. Identifiers can't be bound as
+# parameters so the object names are still interpolated, but keeping the templates
+# in one place means the generated query text is stable from run to run, which lets
+# Snowflake's query parse cache hit. Values always go through bind parameters.
+# Every metadata object is referenced by its fully qualified three-part name:
+# change scripts are free to switch the session's database/schema context (the
+# demo project does exactly that), so the metadata queries can never rely on it.
+_create_database_query = "CREATE DATABASE IF NOT EXISTS {0}"
+_create_schema_query = "CREATE SCHEMA IF NOT EXISTS {0}.{1}"
+_create_table_query = "CREATE TABLE IF NOT EXISTS {0}.{1}.{2} (VERSION VARCHAR, DESCRIPTION VARCHAR, SCRIPT VARCHAR, SCRIPT_TYPE VARCHAR, CHECKSUM VARCHAR, EXECUTION_TIME NUMBER, STATUS VARCHAR, INSTALLED_BY VARCHAR, INSTALLED_ON TIMESTAMP_LTZ)"
+_version_part_order = ", ".join("TRY_TO_NUMBER(SPLIT_PART(VERSION, '.', {0})) DESC NULLS LAST".format(i) for i in range(1, 5))
+_select_max_version_query = "SELECT VERSION FROM {0}.{1}.{2} ORDER BY " + _version_part_order + ", VERSION DESC LIMIT 1"
+_select_versions_query = "SELECT VERSION FROM {0}.{1}.{2}"
+_insert_change_history_query = "INSERT INTO {0}.{1}.{2} (VERSION, DESCRIPTION, SCRIPT, SCRIPT_TYPE, CHECKSUM, EXECUTION_TIME, STATUS, INSTALLED_BY, INSTALLED_ON) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)"
+
+# Cache the Snowflake connection so we only authenticate once per run instead of
+# once per query. The cache is per-thread so parallel script application gets a
+# separate session in each worker thread.
+_thread_state = threading.local()
+_all_connections = list()
+_all_connections_lock = threading.Lock()
+
+
+def snowchange(root_folder, snowflake_account, snowflake_region, snowflake_user, snowflake_role, snowflake_warehouse, change_history_table_override, max_parallel, verbose):
   if "SNOWSQL_PWD" not in os.environ:
     raise ValueError("The SNOWSQL_PWD environment variable has not been defined")
 
+  if max_parallel < 1:
+    raise ValueError("Invalid max parallel value: %d" % max_parallel)
+
   root_folder = os.path.abspath(root_folder)
   if not os.path.isdir(root_folder):
     raise ValueError("Invalid root folder: %s" % root_folder)
@@ -23,123 +81,269 @@ def snowchange(root_folder, snowflake_account, snowflake_region, snowflake_user,
   print("snowchange version: %s" % _snowchange_version)
   print("Using root folder %s" % root_folder)
 
-  # TODO: Is there a better way to do this without setting environment variables?
-  os.environ["SNOWFLAKE_ACCOUNT"] = snowflake_account
-  os.environ["SNOWFLAKE_USER"] = snowflake_user
-  os.environ["SNOWFLAKE_ROLE"] = snowflake_role
-  os.environ["SNOWFLAKE_WAREHOUSE"] = snowflake_warehouse
-  os.environ["SNOWFLAKE_REGION"] = snowflake_region
-  os.environ["SNOWFLAKE_AUTHENTICATOR"] = 'snowflake'
-
-  scripts_skipped = 0
-  scripts_applied = 0
+  # Build the connection details once and pass them explicitly from here on
+  config = SnowflakeConfig(
+    account = snowflake_account,
+    region = snowflake_region,
+    user = snowflake_user,
+    role = snowflake_role,
+    warehouse = snowflake_warehouse,
+    password = os.environ["SNOWSQL_PWD"]
+  )
 
   # Get the change history table details
   change_history_table = get_change_history_table_details(change_history_table_override)
- 
+
   # Create the change history table (and containing objects) if it don't exist.
-  create_change_history_table_if_missing(change_history_table, verbose)
+  create_change_history_table_if_missing(config, change_history_table, verbose)
   print("Using change history table %s.%s.%s" % (change_history_table['database_name'], change_history_table['schema_name'], change_history_table['table_name']))
 
-  # Find the max published version
-  # TODO: Figure out how to directly SELECT the max value from Snowflake with a SQL version of the sorted_alphanumeric() logic
-  max_published_version = ''
-  change_history = fetch_change_history(change_history_table, verbose)
-  if change_history:
-    change_history_sorted = sorted_alphanumeric(change_history)
-    max_published_version = change_history_sorted[-1]
+  # Find all scripts in the root folder (recursively) and sort them correctly.
+  # Sorting by version key (rather than file name) keeps the order consistent
+  # with the version comparison against the max published version.
+  all_scripts = get_all_scripts_recursively(root_folder, verbose)
+
+  # Decorate-sort-undecorate: compute each version key exactly once, sort on the
+  # keys, and keep the sorted key list around for the bisect below
+  decorated_scripts = [(get_alphanum_key(script.version), script) for script in all_scripts]
+  decorated_scripts.sort(key=lambda pair: pair[0])
+  version_keys = [version_key for version_key, script in decorated_scripts]
+  all_scripts_sorted = [script for version_key, script in decorated_scripts]
+
+  # Find the max published version. The script versions are passed along so the
+  # lookup can tell whether the in-database SQL ordering is safe to trust.
+  script_versions = [script.version for script in all_scripts_sorted]
+  max_published_version = fetch_max_published_version(config, change_history_table, script_versions, verbose)
   max_published_version_display = max_published_version
   if max_published_version_display == '':
     max_published_version_display = 'None'
   print("Max applied change script version: %s" % max_published_version_display)
-  if verbose:
-    print("Change history: %s" % change_history)
-
-  # Find all scripts in the root folder (recursively) and sort them correctly
-  all_scripts = get_all_scripts_recursively(root_folder, verbose)
-  all_script_names = list(all_scripts.keys())
-  all_script_names_sorted = sorted_alphanumeric(all_script_names)
 
-  # Loop through each script in order and apply any required changes
-  for script_name in all_script_names_sorted:
-    script = all_scripts[script_name]
+  # Everything at or below the max published version forms a prefix of the sorted
+  # list, so bisect straight to the first script that still needs to be applied
+  # rather than comparing every version key in turn
+  scripts_skipped = bisect.bisect_right(version_keys, get_alphanum_key(max_published_version))
+  pending_scripts = all_scripts_sorted[scripts_skipped:]
+  if verbose and scripts_skipped > 0:
+    print("Skipping %d change scripts at or below the most recently applied change (%s)" % (scripts_skipped, max_published_version))
+
+  # Apply the pending scripts in order. The change history rows are buffered and
+  # flushed in one bulk insert at the end, so wrap the loop in a try/finally to
+  # record partial progress if a script fails.
+  change_history_records = list()
+  change_history_lock = threading.Lock()
+
+  def apply_and_record(script):
+    print("Applying change script %s" % script.name)
+    record = apply_change_script(config, script, verbose)
+    with change_history_lock:
+      change_history_records.append(record)
 
-    # Only apply a change script if the version is newer than the most recent change in the database
-    if get_alphanum_key(script['script_version']) <= get_alphanum_key(max_published_version):
-      if verbose:
-        print("Skipping change script %s because it's older than the most recently applied change (%s)" % (script['script_name'], max_published_version))
-      scripts_skipped += 1
-      continue
-
-    print("Applying change script %s" % script['script_name'])
-    apply_change_script(script, change_history_table, verbose)
-    scripts_applied += 1
+  try:
+    if max_parallel > 1:
+      # One executor for the whole run, so the worker threads (and the Snowflake
+      # session each one caches) are reused across independent groups instead of
+      # re-authenticating per group
+      with concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        for independent, script_group in group_independent_scripts(pending_scripts):
+          if independent and len(script_group) > 1:
+            # These consecutive scripts have been explicitly marked independent,
+            # so apply them concurrently
+            for result in executor.map(apply_and_record, script_group):
+              pass
+          else:
+            for script in script_group:
+              apply_and_record(script)
+    else:
+      for script in pending_scripts:
+        apply_and_record(script)
+  except BaseException:
+    # A failure inside a parallel group can leave a later-versioned sibling
+    # recorded while an earlier script is not; recording it would make the next
+    # run's max-version skip silently drop the failed script forever
+    trim_records_to_contiguous_prefix(pending_scripts, change_history_records)
+    raise
+  finally:
+    record_change_history(config, change_history_table, change_history_records, verbose)
 
+  scripts_applied = len(change_history_records)
   print("Successfully applied %d change scripts (skipping %d)" % (scripts_applied, scripts_skipped))
   print("Completed successfully")
 
+# Applied scripts must form a contiguous version prefix of the pending list: the
+# next run records max(applied) and skips everything at or below it, so a recorded
+# version sitting above an unrecorded one would silently drop that migration
+# forever. After a failure, trim the buffered records back to the contiguous
+# prefix below the first unrecorded script. Re-applying a trimmed sibling on the
+# next run is safe by the operator's own __indep_ declaration - and visible,
+# unlike a skipped migration.
+def trim_records_to_contiguous_prefix(pending_scripts, change_history_records):
+  recorded_versions = set(record[0] for record in change_history_records)
+  cutoff_key = None
+  for script in pending_scripts:
+    if script.version not in recorded_versions:
+      cutoff_key = get_alphanum_key(script.version)
+      break
+  if cutoff_key is None:
+    return
+
+  trimmed_records = [record for record in change_history_records if get_alphanum_key(record[0]) < cutoff_key]
+  records_dropped = len(change_history_records) - len(trimmed_records)
+  if records_dropped > 0:
+    print("Not recording %d change scripts that completed after the failure; they will be re-applied on the next run" % records_dropped)
+    change_history_records[:] = trimmed_records
+
+# Group the sorted scripts into runs that can be applied concurrently. Strict
+# version ordering is the default, so only consecutive scripts that carry the
+# explicit __indep_ marker in their file name (e.g. V1.2.3__indep_load_foo.sql,
+# declaring them safe to run in any order relative to their neighbours) are
+# batched together; every other script gets a group of its own.
+def group_independent_scripts(scripts):
+  groups = list()
+  for script in scripts:
+    independent = '__indep_' in script.name
+    if independent and groups and groups[-1][0]:
+      groups[-1][1].append(script)
+    else:
+      groups.append((independent, [script]))
+  return groups
+
 # This function will return a list containing the parts of the key (split by number parts)
 # Each number is converted to and integer and string parts are left as strings
 # This will enable correct sorting in python when the lists are compared
 # e.g. get_alphanum_key('1.2.2') results in ['', 1, '.', 2, '.', 2, '']
+# The same version strings feed both the sort and the apply loop comparison, so
+# memoize the result rather than re-splitting the string each time
+@functools.lru_cache(maxsize=None)
 def get_alphanum_key(key):
   convert = lambda text: int(text) if text.isdigit() else text.lower()
-  alphanum_key = [ convert(c) for c in re.split('([0-9]+)', key) ]
+  alphanum_key = [ convert(c) for c in _alphanum_pattern.split(key) ]
   return alphanum_key
 
-def sorted_alphanumeric(data):
-  return sorted(data, key=get_alphanum_key)
-
 def get_all_scripts_recursively(root_directory, verbose):
-  all_files = dict()
-  all_versions = list()
-  # Walk the entire directory structure recursively
-  for (directory_path, directory_names, file_names) in os.walk(root_directory):
-    for file_name in file_names:
-      file_full_path = os.path.join(directory_path, file_name)
-      script_name_parts = re.search(r'^([V])(.+)__(.+)\.sql$', file_name.strip())
-
-      # Only process valid change scripts
-      if script_name_parts is None:
-        if verbose:
-          print("Ignoring non-change file " + file_full_path)
-        continue
-
-      # Add this script to our dictionary (as nested dictionary)
-      script = dict()
-      script['script_name'] = file_name
-      script['script_full_path'] = file_full_path
-      script['script_type'] = script_name_parts.group(1)
-      script['script_version'] = script_name_parts.group(2)
-      script['script_description'] = script_name_parts.group(3).replace('_', ' ').capitalize()
-      all_files[file_name] = script
-
-      # Throw an error if the same version exists more than once
-      if script['script_version'] in all_versions:
-        raise ValueError("The script version %s exists more than once (second instance %s)" % (script['script_version'], script['script_full_path']))
-      all_versions.append(script['script_version'])
-
-  return all_files
-
-def execute_snowflake_query(snowflake_database, query, verbose):
-  con = snowflake.connector.connect(
-    user = os.environ["SNOWFLAKE_USER"],
-    account = os.environ["SNOWFLAKE_ACCOUNT"],
-    role = os.environ["SNOWFLAKE_ROLE"],
-    warehouse = os.environ["SNOWFLAKE_WAREHOUSE"],
-    database = snowflake_database,
-    region = os.environ["SNOWFLAKE_REGION"],
-    authenticator = os.environ["SNOWFLAKE_AUTHENTICATOR"],
-    password = os.environ["SNOWSQL_PWD"]
-  )
+  all_scripts = list()
+  all_versions = set()
+  # Walk the entire directory structure recursively. os.scandir is used instead of
+  # os.walk because it hands back the file name, full path and type without any
+  # extra stat() calls, which matters when scanning large script folders.
+  directories_to_walk = [root_directory]
+  while directories_to_walk:
+    with os.scandir(directories_to_walk.pop()) as directory_entries:
+      for entry in directory_entries:
+        if entry.is_dir(follow_symlinks=False):
+          directories_to_walk.append(entry.path)
+          continue
+
+        # Only process valid change scripts, skipping the regex for files that can't match
+        file_name = entry.name
+        script_name_parts = _script_name_pattern.match(file_name) if file_name[:1] == 'V' and file_name.endswith('.sql') else None
+        if script_name_parts is None:
+          if verbose:
+            print("Ignoring non-change file " + entry.path)
+          continue
+
+        # Add this script to our list
+        script = Script(
+          name = file_name,
+          full_path = entry.path,
+          type = script_name_parts.group(1),
+          version = script_name_parts.group(2),
+          description = script_name_parts.group(3).replace('_', ' ').capitalize()
+        )
+        all_scripts.append(script)
+
+        # Throw an error if the same version exists more than once
+        if script.version in all_versions:
+          raise ValueError("The script version %s exists more than once (second instance %s)" % (script.version, script.full_path))
+        all_versions.add(script.version)
+
+  return all_scripts
+
+def get_snowflake_connection(config):
+  con = getattr(_thread_state, 'connection', None)
+  if con is None:
+    con = snowflake.connector.connect(
+      user = config.user,
+      account = config.account,
+      role = config.role,
+      warehouse = config.warehouse,
+      region = config.region,
+      authenticator = config.authenticator,
+      password = config.password,
+      # Keep the session token fresh so long migration runs don't have to reauthenticate
+      client_session_keep_alive = True
+    )
+    _thread_state.connection = con
+    with _all_connections_lock:
+      _all_connections.append(con)
+  return con
+
+def close_snowflake_connection():
+  con = getattr(_thread_state, 'connection', None)
+  if con is not None:
+    _thread_state.connection = None
+    try:
+      con.close()
+    except Exception:
+      # The session may already be dead; dropping the cached handle is what matters
+      pass
+
+def close_all_snowflake_connections():
+  with _all_connections_lock:
+    for con in _all_connections:
+      try:
+        if not con.is_closed():
+          con.close()
+      except Exception:
+        pass
+    del _all_connections[:]
+
+# Make sure the cached connections are cleaned up when the script exits
+atexit.register(close_all_snowflake_connections)
+
+def execute_snowflake_query(config, query, verbose):
+  # Run a single statement and return its cursor
+  con = get_snowflake_connection(config)
 
   if verbose:
       print("SQL query: %s" % query)
 
   try:
-    return con.execute_string(query)
-  finally:
-    con.close()
+    return con.cursor().execute(query)
+  except snowflake.connector.errors.OperationalError:
+    # The session died under us (network drop, admin kill); reconnect once and
+    # retry. SQL errors (ProgrammingError) always bubble up.
+    close_snowflake_connection()
+    con = get_snowflake_connection(config)
+    return con.cursor().execute(query)
+
+def execute_snowflake_script(config, script_content, verbose):
+  # Change scripts can contain any number of statements, so this is the one caller
+  # that still needs the connector's multi-statement string parsing. No automatic
+  # retry here: if the session dies partway through a script, re-running the whole
+  # script blind could re-apply statements that already committed.
+  con = get_snowflake_connection(config)
+
+  if verbose:
+      print("SQL query: %s" % script_content)
+
+  return con.execute_string(script_content)
+
+def execute_snowflake_queries(config, queries, verbose):
+  # Run a group of statements in a single round trip to Snowflake
+  con = get_snowflake_connection(config)
+
+  combined_query = ";\n".join(queries)
+  if verbose:
+      print("SQL query: %s" % combined_query)
+
+  try:
+    return con.cursor().execute(combined_query, num_statements=len(queries))
+  except snowflake.connector.errors.OperationalError:
+    # Safe to retry once on a dead session: these are idempotent metadata statements
+    close_snowflake_connection()
+    con = get_snowflake_connection(config)
+    return con.cursor().execute(combined_query, num_statements=len(queries))
 
 def get_change_history_table_details(change_history_table_override):
   # Start with the global defaults
@@ -164,54 +368,98 @@ def get_change_history_table_details(change_history_table_override):
     else:
       raise ValueError("Invalid change history table name: %s" % change_history_table_override)
 
-  return details
-
-def create_change_history_table_if_missing(change_history_table, verbose):
-  # Create the database if it doesn't exist
-  query = "CREATE DATABASE IF NOT EXISTS {0}".format(change_history_table['database_name'])
-  execute_snowflake_query('', query, verbose)
+  # Resolve the insert statement text once here; with the values bound as
+  # parameters the exact same text is reused for every recorded change
+  details['insert_query'] = _insert_change_history_query.format(details['database_name'], details['schema_name'], details['table_name'])
 
-  # Create the schema if it doesn't exist
-  query = "CREATE SCHEMA IF NOT EXISTS {0}".format(change_history_table['schema_name'])
-  execute_snowflake_query(change_history_table['database_name'], query, verbose)
-
-  # Finally, create the change history table if it doesn't exist
-  query = "CREATE TABLE IF NOT EXISTS {0}.{1} (VERSION VARCHAR, DESCRIPTION VARCHAR, SCRIPT VARCHAR, SCRIPT_TYPE VARCHAR, CHECKSUM VARCHAR, EXECUTION_TIME NUMBER, STATUS VARCHAR, INSTALLED_BY VARCHAR, INSTALLED_ON TIMESTAMP_LTZ)".format(change_history_table['schema_name'], change_history_table['table_name'])
-  execute_snowflake_query(change_history_table['database_name'], query, verbose)
-
-def fetch_change_history(change_history_table, verbose):
-  query = 'SELECT VERSION FROM {0}.{1}'.format(change_history_table['schema_name'], change_history_table['table_name'])
-  results = execute_snowflake_query(change_history_table['database_name'], query, verbose)
-
-  # Collect all the results into a list
-  change_history = list()
-  for cursor in results:
-    for row in cursor:
-      change_history.append(row[0])
-
-  return change_history
+  return details
 
-def apply_change_script(script, change_history_table, verbose):
-  # First read the contents of the script
-  with open(script['script_full_path'],'r') as content_file:
-    content = content_file.read().strip()
-    content = content[:-1] if content.endswith(';') else content
+def create_change_history_table_if_missing(config, change_history_table, verbose):
+  # Create the database, schema and change history table if they don't exist,
+  # all in a single request
+  queries = list()
+  queries.append(_create_database_query.format(change_history_table['database_name']))
+  queries.append(_create_schema_query.format(change_history_table['database_name'], change_history_table['schema_name']))
+  queries.append(_create_table_query.format(change_history_table['database_name'], change_history_table['schema_name'], change_history_table['table_name']))
+  execute_snowflake_queries(config, queries, verbose)
+
+def fetch_max_published_version(config, change_history_table, script_versions, verbose):
+  # Fast path: select the max version directly in Snowflake so only one row is
+  # transferred instead of the entire change history. The SQL ordering (numeric
+  # value of each dotted part) only agrees with get_alphanum_key for purely
+  # numeric dotted versions of at most four parts, so it is only trusted when
+  # every script version - and the value it returns - has that shape. A too-low
+  # max would silently re-apply already-run scripts, so anything else falls back
+  # to fetching all versions and sorting in Python, as before.
+  if all(_simple_version_pattern.match(version) for version in script_versions):
+    query = _select_max_version_query.format(change_history_table['database_name'], change_history_table['schema_name'], change_history_table['table_name'])
+    cursor = execute_snowflake_query(config, query, verbose)
+    row = cursor.fetchone()
+    if row is None:
+      return ''
+    if _simple_version_pattern.match(row[0]):
+      return row[0]
+
+  query = _select_versions_query.format(change_history_table['database_name'], change_history_table['schema_name'], change_history_table['table_name'])
+  cursor = execute_snowflake_query(config, query, verbose)
+  versions = [row[0] for row in cursor.fetchall()]
+  if not versions:
+    return ''
+  return max(versions, key=get_alphanum_key)
+
+def apply_change_script(config, script, verbose):
+  # Read the script once as bytes, feeding both the checksum and the execution
+  # content from the same pass: each chunk goes into the hash as it arrives and is
+  # kept to build the statement text, avoiding a second read of the file and a
+  # UTF-8 re-encode of the content. The checksum is only used for change detection
+  # (it's never treated as a cryptographic guarantee), so use BLAKE2b at the same
+  # 28 byte digest width as the old SHA-224, which hashes markedly faster.
+  checksum_hash = hashlib.blake2b(digest_size=28)
+  raw_content = bytearray()
+  with open(script.full_path,'rb') as content_file:
+    for chunk in iter(lambda: content_file.read(65536), b''):
+      checksum_hash.update(chunk)
+      raw_content += chunk
+  checksum = checksum_hash.hexdigest()
+
+  raw_content = bytes(raw_content).strip()
+  raw_content = raw_content[:-1] if raw_content.endswith(b';') else raw_content
+  content = raw_content.decode('utf-8')
 
   # Define a few other change related variables
-  checksum = hashlib.sha224(content.encode('utf-8')).hexdigest()
   execution_time = 0
   status = 'Success'
 
   # Execute the contents of the script
   if len(content) > 0:
     start = time.time()
-    execute_snowflake_query('', content, verbose)
+    execute_snowflake_script(config, content, verbose)
     end = time.time()
     execution_time = round(end - start)
 
-  # Finally record this change in the change history table
-  query = "INSERT INTO {0}.{1} (VERSION, DESCRIPTION, SCRIPT, SCRIPT_TYPE, CHECKSUM, EXECUTION_TIME, STATUS, INSTALLED_BY, INSTALLED_ON) values ('{2}','{3}','{4}','{5}','{6}',{7},'{8}','{9}',CURRENT_TIMESTAMP);".format(change_history_table['schema_name'], change_history_table['table_name'], script['script_version'], script['script_description'], script['script_name'], script['script_type'], checksum, execution_time, status, os.environ["SNOWFLAKE_USER"])
-  execute_snowflake_query(change_history_table['database_name'], query, verbose)
+  # Finally return this change as a row for the change history table
+  return (script.version, script.description, script.name, script.type, checksum, execution_time, status, config.user)
+
+def record_change_history(config, change_history_table, change_history_records, verbose):
+  # Flush all the buffered changes to the change history table in one bulk insert,
+  # with the values passed as bind parameters rather than formatted into the query
+  if not change_history_records:
+    return
+
+  query = change_history_table['insert_query']
+  if verbose:
+    print("SQL query: %s" % query)
+
+  con = get_snowflake_connection(config)
+  try:
+    con.cursor().executemany(query, change_history_records)
+  except snowflake.connector.errors.OperationalError:
+    # This one statement carries the whole run's history, so a dead session here
+    # must not lose it. Retrying can at worst duplicate a few rows, which the
+    # max-version computation is indifferent to.
+    close_snowflake_connection()
+    con = get_snowflake_connection(config)
+    con.cursor().executemany(query, change_history_records)
 
 
 if __name__ == '__main__':
@@ -223,7 +471,8 @@ if __name__ == '__main__':
   parser.add_argument('-r', '--snowflake-role', type = str, help = 'The name of the role to use (e.g. DEPLOYER_ROLE)', required = True)
   parser.add_argument('-w', '--snowflake-warehouse', type = str, help = 'The name of the warehouse to use (e.g. DEPLOYER_WAREHOUSE)', required = True)
   parser.add_argument('-c', '--change-history-table', type = str, help = 'Used to override the default name of the change history table (e.g. METADATA.SNOWCHANGE.CHANGE_HISTORY)', required = False)
+  parser.add_argument('-p', '--max-parallel', type = int, default = 1, help = 'The maximum number of change scripts to apply concurrently. Only consecutive scripts with the __indep_ marker in their file name (e.g. V1.2.3__indep_load_foo.sql) are applied in parallel.', required = False)
   parser.add_argument('-v','--verbose', action='store_true')
   args = parser.parse_args()
 
-  snowchange(args.root_folder, args.snowflake_account, args.snowflake_region, args.snowflake_user, args.snowflake_role, args.snowflake_warehouse, args.change_history_table, args.verbose)
+  snowchange(args.root_folder, args.snowflake_account, args.snowflake_region, args.snowflake_user, args.snowflake_role, args.snowflake_warehouse, args.change_history_table, args.max_parallel, args.verbose)